@@ -56,6 +56,7 @@ from sqlglot.tokens import (
 from sqlglot.procedure import (
     extract_transpilable_sql as extract_transpilable_sql,
     transpile_procedure as transpile_procedure,
+    transpile_procedures_async as transpile_procedures_async,
 )
 
 if t.TYPE_CHECKING:
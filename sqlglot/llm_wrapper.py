@@ -2,12 +2,39 @@
 
 from __future__ import annotations
 
-import ollama
-from sqlglot import parse_one, transpile
+import hashlib
+import math
+import os
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+from functools import lru_cache
+
+import requests
+
+from sqlglot import parse_one
 from sqlglot import expressions as exp
+from sqlglot.dialects.dialect import Dialect
+from sqlglot.errors import ErrorLevel, ParseError
+from sqlglot.procedure import (
+    LLM_KEEP_ALIVE,
+    LLM_OPTIONS,
+    _loads,
+    _normalize,
+    _post_json,
+    _safe_transpile,
+    _transpile_unique,
+)
+from sqlglot.tokens import TokenType
 
 
-STORED_PROCEDURE_PROMPT = (
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+"""Base URL of the Ollama server, overridable through the `OLLAMA_HOST` environment variable."""
+
+SYSTEM_PROMPT = "You translate SQL between dialects."
+
+PROCEDURE_RULES = (
     "You are an expert in SingleStore Helios stored-procedure syntax and "
     "semantics.  Your job is to take the INPUT_PROCEDURE, identify any "
     "language constructs or SQL features that are not supported by SingleStore, "
@@ -30,30 +57,402 @@ STORED_PROCEDURE_PROMPT = (
     "\u2022 Preserve nested DECLARE blocks, %ROWTYPE and %TYPE uses, and loop or "
     "control-flow constructs, translating them into SingleStore’s procedural "
     "extensions.\n"
+)
+
+PROCEDURE_OUTPUT = (
     "At the end, output the converted procedure code only, formatted with "
     "appropriate DELIMITER commands and SQL fences.\n\n"
     "Here is the procedure to convert.  Replace INPUT_PROCEDURE with the original "
-    "routine:\n\nINPUT_PROCEDURE:\n{procedure}\n\nOUTPUT_PROCEDURE:"
+    "routine:\n\n"
+)
+
+PROCEDURE_DML_RULE = (
+    "\u2022 Convert every data manipulation statement (SELECT, INSERT, UPDATE, "
+    "DELETE, MERGE) to SingleStore syntax inline, translating functions, data "
+    "types and identifier quoting from the source dialect.\n"
+)
+
+PROCEDURE_SYSTEM_PROMPT = PROCEDURE_RULES + PROCEDURE_DML_RULE + PROCEDURE_OUTPUT
+"""The static part of `COMBINED_PROMPT`, baked into `PROCEDURE_MODEL` as its system prompt."""
+
+PROCEDURE_INPUT = "SOURCE_DIALECT: {dialect}\n\nINPUT_PROCEDURE:\n{procedure}\n\nOUTPUT_PROCEDURE:"
+
+COMBINED_PROMPT = PROCEDURE_SYSTEM_PROMPT + PROCEDURE_INPUT
+
+VALIDATION_PROMPT = (
+    "You are converting SQL to SingleStore. Double check that the SQL between the "
+    "<<SQL>> tags is valid SingleStore SQL.\n"
+    "QUERY_TYPE: {kind}\n<<SQL>>\n{sql}\n<<SQL>>"
 )
 
-BREAKDOWN_PROMPT = (
-    "List each data manipulation statement (SELECT, INSERT, UPDATE, DELETE, "
-    "MERGE) from the following stored procedure. Return one statement per "
-    "line in the same order and do not include any additional text.\n\n"
-    "STORED_PROCEDURE:\n{procedure}\n\nSTATEMENTS:"
+PROCEDURE_CONVERTED_RULE = (
+    "\u2022 Most data manipulation statements in INPUT_PROCEDURE are already "
+    "converted to SingleStore. Keep those unchanged and convert any that are not.\n"
 )
 
 REASSEMBLE_PROMPT = (
-    STORED_PROCEDURE_PROMPT
-    + "\nUse these SingleStore statements for the procedure body:\n{converted}\n"
+    PROCEDURE_RULES
+    + PROCEDURE_CONVERTED_RULE
+    + PROCEDURE_OUTPUT
+    + "INPUT_PROCEDURE:\n{procedure}\n\nOUTPUT_PROCEDURE:"
 )
 
+DML_TYPES = (exp.Query, exp.Insert, exp.Update, exp.Delete, exp.Merge)
+
+STOP_SEQUENCES = ["```\n\n", "\n\nNote:", "\n\nExplanation:"]
+"""Generation stops at these, which mark the end of the fenced SQL in a response."""
+
+PROCEDURE_MODEL = "sqlglot-singlestore"
+"""Ollama model that has `PROCEDURE_SYSTEM_PROMPT` built in, see `create_procedure_model`."""
+
+BASE_MODEL = "llama3:8b-instruct-q4_K_M"
+
+MODELS = [
+    PROCEDURE_MODEL,
+    BASE_MODEL,
+    "llama3:8b-instruct-q8_0",
+    "llama3:70b-instruct-q4_K_M",
+]
+"""Suggested models, from fastest to most accurate."""
+
+Span = t.Tuple[int, int]
+Messages = t.List[t.Dict[str, str]]
+Request = t.Tuple[Messages, str, str]
+
+
+@lru_cache(maxsize=512)
+def _cached_parse(sql: str, dialect: str) -> exp.Expression:
+    """Parse the first statement of `sql`. The result is shared, so it must not be mutated."""
+    return parse_one(sql, read=dialect)
+
+
+@lru_cache(maxsize=512)
+def _cached_transpile(sql: str, read: str, write: str) -> str:
+    """Transpile the first statement of `sql`, reusing the cached syntax tree."""
+    return _cached_parse(sql, read).sql(dialect=write)
+
+
+def _extract_dml(sql: str, dialect: str) -> t.List[t.Tuple[str, Span]]:
+    """
+    Extract the top-level DML statements of a stored procedure with sqlglot, in source order.
+
+    Each statement is returned exactly as it appears in `sql`, along with its `(start, end)`
+    offsets in it. Statements nested in other constructs (e.g. the procedure header) and those
+    sqlglot cannot parse are skipped, leaving them for the LLM to convert.
+    """
+    parser_dialect = Dialect.get_or_raise(dialect)
+    chunks: t.List[t.List[t.Any]] = [[]]
+    for token in parser_dialect.tokenize(sql):
+        if token.token_type == TokenType.SEMICOLON:
+            chunks.append([])
+        else:
+            chunks[-1].append(token)
+
+    statements = []
+    for chunk in filter(None, chunks):
+        span = (chunk[0].start, chunk[-1].end + 1)
+        text = sql[span[0] : span[1]]
+        try:
+            trees = parser_dialect.parse(text)
+        except ParseError:
+            continue
+        if len(trees) == 1 and isinstance(trees[0], DML_TYPES):
+            statements.append((text, span))
+
+    return statements
+
+
+def _splice(sql: str, spans: t.Sequence[Span], converted: t.Sequence[str]) -> str:
+    """Replace the statement at each `(start, end)` span of `sql` with its converted counterpart."""
+    parts = []
+    pos = 0
+    for (start, end), replacement in zip(spans, converted):
+        parts.append(sql[pos:start])
+        parts.append(replacement)
+        pos = end
+
+    parts.append(sql[pos:])
+    return "".join(parts)
+
+
+def _strip_fences(response: str) -> str:
+    """
+    Return the SQL in the first fenced block of `response`, or all of it if it has none. The
+    closing fence is usually missing, because Ollama drops the stop sequence that matched it.
+    """
+    start = response.find("```")
+    if start == -1:
+        return response.strip()
+
+    body = response[start + 3 :]
+    if "\n" in body:
+        body = body.split("\n", 1)[1]
+    return body.split("```", 1)[0].strip()
+
+
+def _message_content(data: t.Dict[str, t.Any]) -> str:
+    """Return the message content of an Ollama chat response, raising if it reports an error."""
+    if "error" in data:
+        raise RuntimeError(f"Ollama error: {data['error']}")
+    return data["message"]["content"]
+
+
+def create_procedure_model(base: str = BASE_MODEL, name: str = PROCEDURE_MODEL) -> None:
+    """
+    Create an Ollama model from `base` with the stored procedure conversion rules as its system
+    prompt, so that procedure requests only need to carry the procedure itself. This is the
+    equivalent of running `ollama create` on the Modelfile:
+
+        FROM <base>
+        SYSTEM <PROCEDURE_SYSTEM_PROMPT>
+        PARAMETER num_ctx 4096
+    """
+    payload = {
+        "model": name,
+        "from": base,
+        "system": PROCEDURE_SYSTEM_PROMPT,
+        "parameters": {"num_ctx": LLM_OPTIONS["num_ctx"]},
+        "stream": False,
+    }
+    _post_json(f"{OLLAMA_HOST}/api/create", payload, timeout=600)
+
+
+class _ResponseCache:
+    """A bounded, thread-safe LRU cache of LLM responses.
+
+    Entries expire `ttl` seconds after they are stored. If `embed` is set, a miss on the exact
+    key falls back to the most similar cached prompt within the same scope, as long as the cosine
+    similarity of their embeddings is at least `threshold`.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        ttl: float = 3600.0,
+        threshold: float = 0.92,
+        embed: t.Optional[t.Callable[[str], t.List[float]]] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.embed = embed
+        self._entries: OrderedDict[str, t.Tuple[float, str, str, t.Optional[t.List[float]]]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, scope: str, text: str) -> t.Tuple[t.Optional[str], t.Optional[t.List[float]]]:
+        """Look up the response for `text` within `scope`.
+
+        Returns:
+            The cached response, or None on a miss, along with the embedding of `text` if
+            embeddings are enabled, so it can be passed on to `set`.
+        """
+        now = time.monotonic()
+        key = self._key(scope, text)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] < self.ttl:
+                    self._entries.move_to_end(key)
+                    return entry[2], entry[3]
+                del self._entries[key]
+
+        if self.embed is None:
+            return None, None
+
+        # Embedding is a network call, so it must not hold up other threads
+        vector = self._unit(self.embed(text))
+        with self._lock:
+            return self._most_similar(scope, vector, now), vector
+
+    def set(
+        self, scope: str, text: str, response: str, vector: t.Optional[t.List[float]] = None
+    ) -> None:
+        key = self._key(scope, text)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), scope, response, vector)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def contains(self, scope: str, text: str) -> bool:
+        """Whether an unexpired response is stored for exactly `text` within `scope`."""
+        key = self._key(scope, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    def get_or_call(self, scope: str, text: str, call: t.Callable[[], str]) -> str:
+        """Return the cached response for `text` within `scope`, or store the result of `call`."""
+        response, vector = self.get(scope, text)
+        if response is None:
+            response = call()
+            self.set(scope, text, response, vector)
+        return response
+
+    @staticmethod
+    def _key(scope: str, text: str) -> str:
+        return hashlib.sha256(f"{scope}|{text}".encode()).hexdigest()
+
+    def _most_similar(self, scope: str, vector: t.List[float], now: float) -> t.Optional[str]:
+        # The caller must hold the lock
+        best_key, best_score = None, self.threshold
+        for key, (created, entry_scope, _, other) in self._entries.items():
+            if other is None or entry_scope != scope or now - created >= self.ttl:
+                continue
+            score = sum(a * b for a, b in zip(vector, other))
+            if score >= best_score:
+                best_key, best_score = key, score
+
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key][2]
+
+    @staticmethod
+    def _unit(vector: t.List[float]) -> t.List[float]:
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
 
 class LLMWrapper:
-    """Generate SingleStore SQL using Ollama."""
+    """Generate SingleStore SQL using Ollama.
+
+    Stored procedures are converted with a single LLM call. With `multi_step`, their DML
+    statements are instead extracted and transpiled with sqlglot and substituted into the
+    procedure, which is then handed to the LLM to convert the rest. Procedures without any
+    top-level DML that sqlglot can parse fall back to the single call.
+
+    `PROCEDURE_MODEL` is created from `base_model` on first use if it does not exist yet. Since
+    it has the procedure conversion rules built in, they are not sent with each procedure.
 
-    def __init__(self, model: str = "llama3") -> None:
+    Setting `draft_model` enables speculative decoding, where the draft model proposes
+    `num_draft` tokens at a time for the main model to verify. This requires an Ollama build
+    that supports the `draft_model` option.
+
+    Responses are cached per model, dialect and query kind. Setting `embed_model` additionally
+    returns the response of a previously seen, sufficiently similar input on a cache miss.
+    """
+
+    def __init__(
+        self,
+        model: str = MODELS[0],
+        cache_size: int = 256,
+        cache_ttl: float = 3600.0,
+        embed_model: str | None = None,
+        similarity_threshold: float = 0.92,
+        multi_step: bool = False,
+        draft_model: str | None = None,
+        num_draft: int = 8,
+        base_model: str = BASE_MODEL,
+    ) -> None:
         self.model = model
+        self.base_model = base_model
+        self._model_checked = model != PROCEDURE_MODEL
+        self.multi_step = multi_step
+        self.options: t.Dict[str, t.Any] = dict(LLM_OPTIONS)
+        if draft_model:
+            self.options.update(draft_model=draft_model, num_draft=num_draft)
+        self.embed_model = embed_model
+        self._cache = _ResponseCache(
+            max_entries=cache_size,
+            ttl=cache_ttl,
+            threshold=similarity_threshold,
+            embed=self._embed if embed_model else None,
+        )
+
+    def _embed(self, text: str) -> t.List[float]:
+        payload = {"model": self.embed_model, "prompt": text, "keep_alive": LLM_KEEP_ALIVE}
+        return _loads(_post_json(f"{OLLAMA_HOST}/api/embeddings", payload).content)["embedding"]
+
+    def _options(self, kind: str, text: str) -> t.Dict[str, t.Any]:
+        """
+        Cap the response length and stop generating once the fenced SQL is complete. Validation
+        responses get about twice as many tokens as the SQL they check, at 4 characters per token.
+        """
+        if kind in ("stored procedure", "reassemble"):
+            return {**self.options, "num_predict": 4096, "stop": STOP_SEQUENCES}
+        return {
+            **self.options,
+            "num_predict": max(256, 2 * len(text) // 4),
+            "stop": STOP_SEQUENCES,
+            "temperature": 0.0,
+        }
+
+    def _chat_payload(
+        self, messages: Messages, options: t.Dict[str, t.Any], stream: bool = False
+    ) -> t.Dict[str, t.Any]:
+        return {
+            "model": self.model,
+            "messages": messages,
+            "stream": stream,
+            "options": options,
+            "keep_alive": LLM_KEEP_ALIVE,
+        }
+
+    def _ensure_model(self) -> None:
+        if self._model_checked:
+            return
+        try:
+            _post_json(f"{OLLAMA_HOST}/api/show", {"model": self.model})
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            create_procedure_model(self.base_model, self.model)
+        self._model_checked = True
+
+    def _post_chat(self, messages: Messages, options: t.Dict[str, t.Any]) -> str:
+        self._ensure_model()
+        payload = self._chat_payload(messages, options)
+        response = _post_json(f"{OLLAMA_HOST}/api/chat", payload, timeout=120)
+        return _message_content(_loads(response.content))
+
+    def _post_chat_stream(self, messages: Messages, options: t.Dict[str, t.Any]) -> t.Iterator[str]:
+        self._ensure_model()
+        with _post_json(
+            f"{OLLAMA_HOST}/api/chat",
+            self._chat_payload(messages, options, stream=True),
+            timeout=120,
+            stream=True,
+        ) as response:
+            for line in response.iter_lines():
+                if line:
+                    yield _message_content(_loads(line))
+
+    def _chat(self, messages: Messages, kind: str, dialect: str, text: str) -> str:
+        """Send `messages` to the model, reusing the cached response for the same input."""
+        return self._cache.get_or_call(
+            self._scope(kind, dialect),
+            self._cache_text(kind, dialect, text),
+            lambda: self._post_chat(messages, self._options(kind, text)),
+        )
+
+    def _chat_stream(
+        self, messages: Messages, kind: str, dialect: str, text: str
+    ) -> t.Iterator[str]:
+        """Like `_chat`, but yields the response in chunks as the model generates it."""
+        scope = self._scope(kind, dialect)
+        key = self._cache_text(kind, dialect, text)
+
+        cached, vector = self._cache.get(scope, key)
+        if cached is not None:
+            yield cached
+            return
+
+        chunks = []
+        for content in self._post_chat_stream(messages, self._options(kind, text)):
+            chunks.append(content)
+            yield content
+
+        self._cache.set(scope, key, "".join(chunks), vector)
+
+    def _scope(self, kind: str, dialect: str) -> str:
+        return f"{self.model}|{dialect}|{kind}"
+
+    def _cache_text(self, kind: str, dialect: str, text: str) -> str:
+        # Queries are cached by their SingleStore transpilation, procedures by their source
+        return _normalize(text, "singlestore" if kind.endswith("query") else dialect)
 
     def _query_type(self, expression: exp.Expression) -> str:
         if isinstance(expression, exp.Create) and ((expression.kind or "").upper() == "PROCEDURE"):
@@ -64,65 +463,104 @@ class LLMWrapper:
             return "DDL query"
         return "query"
 
-    def _prompt(self, kind: str, sql: str, dialect: str | None) -> str:
-        if kind == "stored procedure":
-            return STORED_PROCEDURE_PROMPT.format(procedure=sql)
-        return f"Double check that the following {kind} is valid SingleStore SQL:\n{sql}"
-
-    def _decompose_procedure(self, sql: str) -> list[str]:
-        """Use the LLM to extract DML statements from a stored procedure."""
-        prompt = BREAKDOWN_PROMPT.format(procedure=sql)
+    def _reassemble_request(self, procedure: str) -> Request:
+        """Build the request that asks the LLM to finish a procedure whose DML is converted."""
+        prompt = REASSEMBLE_PROMPT.format(procedure=procedure)
         messages = [
-            {"role": "system", "content": "You extract SQL statements."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
         ]
-        response = ollama.chat(model=self.model, messages=messages)
-        content = response["message"]["content"]
-        return [line.strip() for line in content.splitlines() if line.strip()]
+        return messages, "reassemble", procedure
+
+    def _procedure_request(self, sql: str, dialect: str) -> Request:
+        """Build the request that converts a stored procedure to SingleStore."""
+        if self.multi_step:
+            extracted = _extract_dml(sql, dialect)
+            if extracted:
+                statements, spans = zip(*extracted)
+                converted = _transpile_unique(_safe_transpile, statements, dialect, "singlestore")
+                return self._reassemble_request(_splice(sql, spans, converted))
+
+        if self.model == PROCEDURE_MODEL:
+            # A system message would override the rules baked into the model
+            prompt = PROCEDURE_INPUT.format(dialect=dialect, procedure=sql)
+            return [{"role": "user", "content": prompt}], "stored procedure", sql
 
-    def _reassemble_procedure(self, original: str, converted: str) -> str:
-        """Use the LLM to create a SingleStore procedure from converted DML."""
-        prompt = REASSEMBLE_PROMPT.format(procedure=original, converted=converted)
+        prompt = COMBINED_PROMPT.format(dialect=dialect, procedure=sql)
         messages = [
-            {"role": "system", "content": "You translate SQL between dialects."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
         ]
-        response = ollama.chat(model=self.model, messages=messages)
-        return response["message"]["content"].strip()
-
-    def _transpile_procedure(self, sql: str, dialect: str) -> str:
-        """Break down, transpile, and rebuild a stored procedure."""
-        statements = self._decompose_procedure(sql)
-        converted = []
-        for stmt in statements:
-            text = stmt.rstrip(";")
-            try:
-                text = transpile(text, read=dialect, write="singlestore")[0]
-            except Exception:
-                pass  # best effort
-            converted.append(text + ";")
-        joined = "\n".join(converted)
-        return self._reassemble_procedure(sql, joined)
+        return messages, "stored procedure", sql
 
-    def to_singlestore(self, sql: str, dialect: str = "tsql") -> str:
-        """Translate SQL from the given dialect to SingleStore SQL."""
+    def _request(self, sql: str, dialect: str) -> Request:
+        """Build the final chat request for `sql` as a (messages, kind, cache text) tuple."""
         try:
-            expression = parse_one(sql, read=dialect)
+            expression = _cached_parse(sql, dialect)
         except Exception as e:  # pragma: no cover - best effort parsing
             raise ValueError("Please provide sql.") from e
 
         kind = self._query_type(expression)
 
         if kind == "stored procedure":
-            return self._transpile_procedure(sql, dialect)
+            return self._procedure_request(sql, dialect)
 
-        transpiled = transpile(sql, read=dialect, write="singlestore")[0]
-        prompt = self._prompt(kind, transpiled, None)
+        transpiled = _cached_transpile(sql, dialect, "singlestore")
+        prompt = VALIDATION_PROMPT.format(kind=kind, sql=transpiled)
 
         messages = [
-            {"role": "system", "content": "You translate SQL between dialects."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
         ]
 
-        response = ollama.chat(model=self.model, messages=messages)
-        return response["message"]["content"].strip()
+        return messages, kind, transpiled
+
+    def _local_translation(self, sql: str, dialect: str) -> str | None:
+        """
+        Translate `sql` with sqlglot alone if that is safe, i.e. the input is not a stored
+        procedure, sqlglot fully supports it and its output round-trips through SingleStore
+        unchanged. Otherwise, return None so that the LLM is consulted.
+        """
+        try:
+            expression = _cached_parse(sql, dialect)
+            if self._query_type(expression) == "stored procedure" or expression.find(exp.Command):
+                return None
+
+            transpiled = expression.sql(dialect="singlestore", unsupported_level=ErrorLevel.RAISE)
+            round_trip = _cached_transpile(transpiled, "singlestore", "singlestore")
+        except Exception:
+            return None
+
+        return transpiled if round_trip == transpiled else None
+
+    def to_singlestore(self, sql: str, dialect: str = "tsql") -> str:
+        """Translate SQL from the given dialect to SingleStore SQL."""
+        local = self._local_translation(sql, dialect)
+        if local is not None:
+            return local
+
+        messages, kind, text = self._request(sql, dialect)
+        return _strip_fences(self._chat(messages, kind, dialect, text))
+
+    def is_cached(self, sql: str, dialect: str = "tsql") -> bool:
+        """Whether `to_singlestore` can translate `sql` without waiting for the model."""
+        if self._local_translation(sql, dialect) is not None:
+            return True
+
+        _, kind, text = self._request(sql, dialect)
+        return self._cache.contains(
+            self._scope(kind, dialect), self._cache_text(kind, dialect, text)
+        )
+
+    def to_singlestore_stream(self, sql: str, dialect: str = "tsql") -> t.Iterator[str]:
+        """
+        Like `to_singlestore`, but yields the translation in chunks as it is generated. The
+        chunks are the raw response, including the fence around the SQL.
+        """
+        local = self._local_translation(sql, dialect)
+        if local is not None:
+            yield local
+            return
+
+        messages, kind, text = self._request(sql, dialect)
+        yield from self._chat_stream(messages, kind, dialect, text)
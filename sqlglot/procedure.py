@@ -2,36 +2,212 @@
 
 from __future__ import annotations
 
-from typing import Iterable, List
+import asyncio
+import atexit
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+if TYPE_CHECKING:
+    import httpx
+
+try:
+    import orjson
+
+    USE_ORJSON = True
+except ImportError:
+    USE_ORJSON = False
 
 
 LLM_URL = "http://localhost:11434/api/generate"
 """Default endpoint for a local LLM (Ollama compatible)."""
 
+LLM_KEEP_ALIVE = "30m"
+"""How long Ollama keeps the model loaded after a call, so follow-up calls avoid a cold load."""
+
+LLM_OPTIONS = {"num_ctx": 4096, "num_batch": 512}
+"""Model options sent with every request. Procedures are short, so a 4096 token context suffices."""
+
+T = TypeVar("T")
+
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_LOCK = threading.Lock()
+
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=4, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.3)
+)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+
+def _transpile_statement(args: Tuple[str, str, str]) -> str:
+    """Transpile a single `(sql, read, write)` statement."""
+    from sqlglot import transpile
+
+    sql, read, write = args
+    return transpile(sql, read=read, write=write)[0]
+
+
+def _safe_transpile(args: Tuple[str, str, str]) -> str:
+    """Like `_transpile_statement`, but falls back to the original SQL if it fails."""
+    try:
+        return _transpile_statement(args)
+    except Exception:
+        return args[0]
+
+
+def _parallel_map(
+    func: Callable[[Tuple[str, str, str]], T], items: Sequence[Tuple[str, str, str]]
+) -> List[T]:
+    """
+    Apply `func` to every item, using worker processes when there is more than one item. If a
+    worker dies, the pool is discarded so the next call starts a fresh one, and the items are
+    processed in the current process instead.
+    """
+    if len(items) >= 2:
+        pool = _get_pool()
+        try:
+            return list(pool.map(func, items))
+        except BrokenProcessPool:
+            _discard_pool(pool)
+    return [func(item) for item in items]
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Return the process pool shared by all calls, creating it on first use."""
+    global _POOL
+
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+            atexit.register(_POOL.shutdown)
+        return _POOL
+
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop `pool` if it is still the shared one, e.g. because one of its workers died."""
+    global _POOL
+
+    with _POOL_LOCK:
+        if _POOL is pool:
+            _POOL = None
+    pool.shutdown(wait=False)
+
+
+def _normalize(sql: str, dialect: str) -> str:
+    """
+    Normalize `sql` by joining its tokens with single spaces. Unlike collapsing all whitespace,
+    this keeps the contents of string literals and quoted identifiers intact. Falls back to
+    `sql` itself if it cannot be tokenized.
+    """
+    from sqlglot.dialects.dialect import Dialect
+    from sqlglot.errors import TokenError
+
+    try:
+        tokens = Dialect.get_or_raise(dialect).tokenize(sql)
+    except TokenError:
+        return sql
+    return " ".join(sql[token.start : token.end + 1] for token in tokens)
+
+
+def _transpile_unique(
+    func: Callable[[Tuple[str, str, str]], str], statements: Sequence[str], read: str, write: str
+) -> List[str]:
+    """Transpile `statements` with `func`, transpiling repeated statements only once."""
+    keys = [_normalize(stmt, read) for stmt in statements]
+    unique: Dict[str, str] = {}
+    for key, stmt in zip(keys, statements):
+        unique.setdefault(key, stmt)
+
+    converted = _parallel_map(func, [(stmt, read, write) for stmt in unique.values()])
+    by_key = dict(zip(unique, converted))
+    return [by_key[key] for key in keys]
+
+
+def _payload(prompt: str, model: str) -> dict:
+    return {
+        "model": model,
+        "prompt": prompt,
+        "stream": False,
+        "options": LLM_OPTIONS,
+        "keep_alive": LLM_KEEP_ALIVE,
+    }
+
+
+def _dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj) if USE_ORJSON else json.dumps(obj).encode("utf-8")
+
+
+def _loads(data: bytes) -> Any:
+    return orjson.loads(data) if USE_ORJSON else json.loads(data)
+
+
+def _post_json(
+    url: str, payload: dict, timeout: int = 60, stream: bool = False
+) -> requests.Response:
+    """POST `payload` as JSON through the shared session and check the response status."""
+    response = _SESSION.post(
+        url,
+        data=_dumps(payload),
+        headers={"Content-Type": "application/json"},
+        timeout=timeout,
+        stream=stream,
+    )
+    response.raise_for_status()
+    return response
+
 
 def _call_llm(prompt: str, model: str = "llama2", url: str = LLM_URL) -> str:
     """Call a local LLM to process a prompt and return the raw response."""
-    payload = {"model": model, "prompt": prompt, "stream": False}
-    response = requests.post(url, json=payload, timeout=60)
+    data = _loads(_post_json(url, _payload(prompt, model)).content)
+    return data.get("response", "")
+
+
+async def _call_llm_async(
+    client: httpx.AsyncClient, prompt: str, model: str = "llama2", url: str = LLM_URL
+) -> str:
+    """Like `_call_llm`, but sends the request through an async httpx client."""
+    response = await client.post(
+        url, content=_dumps(_payload(prompt, model)), headers={"Content-Type": "application/json"}
+    )
     response.raise_for_status()
-    data = response.json()
+    data = _loads(response.content)
     return data.get("response", "")
 
 
-def extract_transpilable_sql(
-    procedure: str, model: str = "llama2", url: str = LLM_URL
-) -> List[str]:
-    """Use a local LLM to extract transpilable SQL statements from a stored procedure."""
-    prompt = (
+def _extraction_prompt(procedure: str) -> str:
+    return (
         "Extract the SQL statements from the following stored procedure. "
         "Return the statements separated by a semicolon.\n" + procedure
     )
-    raw = _call_llm(prompt, model=model, url=url)
+
+
+def _split_statements(raw: str) -> List[str]:
     return [s.strip() for s in raw.split(";") if s.strip()]
 
 
+def _wrap_procedure(statements: List[str], read: str, write: str) -> str:
+    converted = _transpile_unique(_transpile_statement, statements, read, write)
+    body = ";\n".join(converted) + ";"
+    return f"DELIMITER //\n{body}\n//\nDELIMITER ;"
+
+
+def extract_transpilable_sql(
+    procedure: str, model: str = "llama2", url: str = LLM_URL
+) -> List[str]:
+    """Use a local LLM to extract transpilable SQL statements from a stored procedure."""
+    raw = _call_llm(_extraction_prompt(procedure), model=model, url=url)
+    return _split_statements(raw)
+
+
 def transpile_procedure(
     procedure: str,
     read: str = "tsql",
@@ -40,11 +216,39 @@ def transpile_procedure(
     url: str = LLM_URL,
 ) -> str:
     """Transpile SQL inside a stored procedure into SingleStore syntax."""
-    from sqlglot import transpile
-
     statements = extract_transpilable_sql(procedure, model=model, url=url)
-    converted: Iterable[str] = (
-        transpile(stmt, read=read, write=write)[0] for stmt in statements
+    return _wrap_procedure(statements, read, write)
+
+
+async def transpile_procedures_async(
+    procedures: Sequence[str],
+    read: str = "tsql",
+    write: str = "singlestore",
+    model: str = "llama2",
+    url: str = LLM_URL,
+    transport: Optional[httpx.AsyncBaseTransport] = None,
+) -> List[str]:
+    """
+    Transpile several stored procedures into SingleStore syntax, issuing their LLM calls
+    concurrently over a shared connection pool. Requires the `httpx` package.
+
+    The statements are transpiled in the default executor so they don't block the event loop.
+    """
+    import httpx
+
+    limits = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+    async with httpx.AsyncClient(limits=limits, timeout=60, transport=transport) as client:
+        raws = await asyncio.gather(
+            *(
+                _call_llm_async(client, _extraction_prompt(procedure), model=model, url=url)
+                for procedure in procedures
+            )
+        )
+
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(
+        *(
+            loop.run_in_executor(None, _wrap_procedure, _split_statements(raw), read, write)
+            for raw in raws
+        )
     )
-    body = ";\n".join(converted) + ";"
-    return f"DELIMITER //\n{body}\n//\nDELIMITER ;"
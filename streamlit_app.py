@@ -1,28 +1,60 @@
 import streamlit as st
 from sqlglot.dialects import DIALECTS
-from sqlglot.llm_wrapper import LLMWrapper
+from sqlglot.llm_wrapper import MODELS, LLMWrapper
+
+
+TTL = 3600
+MAX_ENTRIES = 500
+
+
+@st.cache_resource
+def get_wrapper(model: str) -> LLMWrapper:
+    # Bound the wrapper cache like _translate's, so that is_cached agrees with it
+    return LLMWrapper(model=model, cache_size=MAX_ENTRIES, cache_ttl=TTL)
+
+
+@st.cache_resource
+def _dialect_choices() -> tuple:
+    dialects = sorted({d.lower() for d in DIALECTS} - {"singlestore"})
+    return dialects, dialects.index("tsql") if "tsql" in dialects else 0
+
+
+@st.cache_data(ttl=TTL, max_entries=MAX_ENTRIES, show_spinner=False)
+def _translate(sql: str, dialect: str, model: str) -> str:
+    # This must not call st: Streamlit replays such calls on a cache hit, and replaying them
+    # into an element created outside of the function raises CacheReplayClosureError
+    return get_wrapper(model).to_singlestore(sql, dialect)
+
+
+_SOURCE_DIALECTS, _DEFAULT_IDX = _dialect_choices()
 
 st.title("SQL to SingleStore Translator")
 
 sql = st.text_area("Enter SQL to convert")
 
-wrapper = LLMWrapper()
+model = st.sidebar.selectbox("Model", MODELS)
 
-source_dialects = [d.lower() for d in DIALECTS if d.lower() != "singlestore"]
-source_dialects = sorted(source_dialects)
-default_index = source_dialects.index("tsql") if "tsql" in source_dialects else 0
 source = st.selectbox(
     "Input dialect",
-    source_dialects,
-    index=default_index,
+    _SOURCE_DIALECTS,
+    index=_DEFAULT_IDX,
 )
 
 if st.button("Convert"):
     if sql:
         try:
-            translated = wrapper.to_singlestore(sql, source)
             st.subheader("SingleStore SQL")
-            st.code(translated, language="sql")
+            placeholder = st.empty()
+            wrapper = get_wrapper(model)
+            if not wrapper.is_cached(sql, source):
+                # Stream the translation while the model generates it. The wrapper caches the
+                # response, so the _translate call below returns it without another LLM round
+                # trip, and repeated clicks are then served straight from the _translate cache.
+                translated = ""
+                for chunk in wrapper.to_singlestore_stream(sql, source):
+                    translated += chunk
+                    placeholder.code(translated, language="sql")
+            placeholder.code(_translate(sql, source, model), language="sql")
         except ValueError as ve:
             st.error(str(ve))
         except Exception as e:
@@ -0,0 +1,258 @@
+import threading
+import unittest
+from unittest import mock
+
+from sqlglot.llm_wrapper import (
+    BASE_MODEL,
+    PROCEDURE_INPUT,
+    PROCEDURE_SYSTEM_PROMPT,
+    LLMWrapper,
+    _extract_dml,
+    _ResponseCache,
+    _splice,
+    _strip_fences,
+    _transpile_unique,
+)
+
+PROCEDURE = """CREATE PROCEDURE dbo.p @x INT AS
+BEGIN
+  SET NOCOUNT ON;
+  INSERT INTO t (a)
+    SELECT TOP 1 a FROM s WHERE b = @x;
+  UPDATE t SET a = ISNULL(b, 0);
+END"""
+
+
+class TestLLMWrapper(unittest.TestCase):
+    def test_splice(self):
+        self.assertEqual(
+            _splice("BEGIN SELECT  1; SELECT 2; END", [(6, 15)], ["x"]),
+            "BEGIN x; SELECT 2; END",
+        )
+        self.assertEqual(_splice("SELECT 1; SELECT 1;", [(0, 8), (10, 18)], ["x", "y"]), "x; y;")
+
+        sql = "CREATE PROCEDURE p AS BEGIN SET @q = 'SELECT ISNULL(a, 0) FROM t2'; SELECT ISNULL(a, 0) FROM t; END"
+        statements = _extract_dml(sql, "tsql")
+        self.assertEqual(statements, [("SELECT ISNULL(a, 0) FROM t", (68, 94))])
+        self.assertEqual(
+            _splice(sql, [span for _, span in statements], ["SELECT COALESCE(a, 0) FROM t"]),
+            "CREATE PROCEDURE p AS BEGIN SET @q = 'SELECT ISNULL(a, 0) FROM t2'; SELECT COALESCE(a, 0) FROM t; END",
+        )
+
+    @mock.patch.object(LLMWrapper, "_post_chat", return_value="converted")
+    def test_local_translation(self, post_chat):
+        wrapper = LLMWrapper()
+
+        self.assertEqual(
+            wrapper.to_singlestore("SELECT ISNULL(a, 0) FROM t", "tsql"),
+            "SELECT COALESCE(a, 0) FROM t",
+        )
+        self.assertEqual(list(wrapper.to_singlestore_stream("SELECT 1", "tsql")), ["SELECT 1"])
+        post_chat.assert_not_called()
+
+        self.assertEqual(wrapper.to_singlestore("SELECT TOP 1 a FROM t", "tsql"), "converted")
+        post_chat.assert_called_once()
+
+        options = post_chat.call_args[0][1]
+        self.assertEqual(options["num_predict"], 256)
+        self.assertEqual(options["temperature"], 0.0)
+        self.assertIn("```\n\n", options["stop"])
+
+    def test_strip_fences(self):
+        self.assertEqual(_strip_fences(" SELECT 1 \n"), "SELECT 1")
+        self.assertEqual(_strip_fences("```sql\nSELECT 1\n"), "SELECT 1")
+        self.assertEqual(_strip_fences("Fixed:\n```sql\nSELECT 1\n```\nDone"), "SELECT 1")
+
+    @mock.patch.object(LLMWrapper, "_post_chat", return_value="```sql\nSELECT a FROM t LIMIT 1\n")
+    def test_unclosed_fence(self, post_chat):
+        self.assertEqual(
+            LLMWrapper().to_singlestore("SELECT TOP 1 a FROM t", "tsql"), "SELECT a FROM t LIMIT 1"
+        )
+
+    @mock.patch.object(LLMWrapper, "_post_chat", return_value="converted")
+    def test_procedure(self, post_chat):
+        self.assertEqual(LLMWrapper().to_singlestore(PROCEDURE, "tsql"), "converted")
+        self.assertEqual(
+            post_chat.call_args[0][0],
+            [
+                {
+                    "role": "user",
+                    "content": f"SOURCE_DIALECT: tsql\n\nINPUT_PROCEDURE:\n{PROCEDURE}\n\nOUTPUT_PROCEDURE:",
+                }
+            ],
+        )
+
+        LLMWrapper(model=BASE_MODEL).to_singlestore(PROCEDURE, "tsql")
+        system, user = post_chat.call_args[0][0]
+        self.assertEqual(system["role"], "system")
+        self.assertTrue(user["content"].startswith(PROCEDURE_SYSTEM_PROMPT))
+
+    @mock.patch.object(LLMWrapper, "_post_chat", return_value="converted")
+    def test_multi_step_procedure(self, post_chat):
+        wrapper = LLMWrapper(multi_step=True)
+
+        self.assertEqual(wrapper.to_singlestore(PROCEDURE, "tsql"), "converted")
+        post_chat.assert_called_once()
+
+        prompt = post_chat.call_args[0][0][1]["content"]
+        self.assertEqual(prompt.count("INSERT INTO"), 1)
+        self.assertIn(
+            "INPUT_PROCEDURE:\nCREATE PROCEDURE dbo.p @x INT AS\nBEGIN\n  SET NOCOUNT ON;\n"
+            "  INSERT INTO t (a) SELECT a FROM s WHERE b = @x LIMIT 1;\n"
+            "  UPDATE t SET a = COALESCE(b, 0);\nEND\n\nOUTPUT_PROCEDURE:",
+            prompt,
+        )
+
+    @mock.patch.object(LLMWrapper, "_post_chat", return_value="converted")
+    def test_multi_step_procedure_string_literal(self, post_chat):
+        sql = "CREATE PROCEDURE p AS BEGIN SET @q = 'SELECT ISNULL(a, 0) FROM t2'; SELECT ISNULL(a, 0) FROM t; END"
+        LLMWrapper(multi_step=True).to_singlestore(sql, "tsql")
+
+        prompt = post_chat.call_args[0][0][1]["content"]
+        self.assertIn(
+            "SET @q = 'SELECT ISNULL(a, 0) FROM t2'; SELECT COALESCE(a, 0) FROM t; END", prompt
+        )
+
+    @mock.patch("sqlglot.llm_wrapper._transpile_unique", wraps=_transpile_unique)
+    @mock.patch.object(LLMWrapper, "_post_chat", return_value="converted")
+    def test_multi_step_unparsed_statements(self, post_chat, transpile_unique):
+        wrapper = LLMWrapper(multi_step=True)
+
+        sql = "CREATE PROCEDURE p AS BEGIN DECLARE @c CURSOR FOR SELECT a FROM t; UPDATE t SET a = ISNULL(b, 0); END"
+        wrapper.to_singlestore(sql, "tsql")
+        post_chat.assert_called_once()
+        self.assertEqual(transpile_unique.call_args[0][1], ("UPDATE t SET a = ISNULL(b, 0)",))
+        self.assertIn(
+            "SELECT a FROM t; UPDATE t SET a = COALESCE(b, 0); END",
+            post_chat.call_args[0][0][1]["content"],
+        )
+
+        # Without any top-level DML to splice in, the procedure is converted in a single call
+        sql = "CREATE PROCEDURE p AS SELECT TOP 1 a FROM t"
+        wrapper.to_singlestore(sql, "tsql")
+        self.assertEqual(post_chat.call_count, 2)
+        transpile_unique.assert_called_once()
+        self.assertEqual(
+            post_chat.call_args[0][0],
+            [{"role": "user", "content": PROCEDURE_INPUT.format(dialect="tsql", procedure=sql)}],
+        )
+
+    @mock.patch("sqlglot.llm_wrapper.time.monotonic", return_value=0.0)
+    @mock.patch.object(LLMWrapper, "_post_chat", return_value="converted")
+    def test_is_cached(self, post_chat, monotonic):
+        wrapper = LLMWrapper(cache_ttl=10)
+
+        self.assertTrue(wrapper.is_cached("SELECT 1", "tsql"))
+        self.assertFalse(wrapper.is_cached(PROCEDURE, "tsql"))
+        wrapper.to_singlestore(PROCEDURE, "tsql")
+        self.assertTrue(wrapper.is_cached(PROCEDURE, "tsql"))
+
+        monotonic.return_value = 10.0
+        self.assertFalse(wrapper.is_cached(PROCEDURE, "tsql"))
+        post_chat.assert_called_once()
+
+    @mock.patch.object(LLMWrapper, "_post_chat", side_effect=["x", "y"])
+    def test_cache_literals(self, post_chat):
+        wrapper = LLMWrapper()
+        sql = "CREATE PROCEDURE p AS BEGIN SELECT * FROM t WHERE n = '{}'; END"
+
+        self.assertEqual(wrapper.to_singlestore(sql.format("a  b"), "tsql"), "x")
+        self.assertEqual(wrapper.to_singlestore(sql.format("a b"), "tsql"), "y")
+        self.assertEqual(
+            wrapper.to_singlestore(sql.format("a  b").replace(" ", "\n", 2), "tsql"), "x"
+        )
+        self.assertEqual(post_chat.call_count, 2)
+
+    @mock.patch("sqlglot.llm_wrapper._post_json")
+    def test_stream(self, post_json):
+        lines = [b'{"message": {"content": "SELECT "}}', b"", b'{"message": {"content": "1"}}']
+        post_json.return_value.__enter__.return_value.iter_lines.return_value = lines
+        sql = "SELECT TOP 1 a" + " " * 1000 + "FROM t"
+        wrapper = LLMWrapper(model=BASE_MODEL)
+
+        self.assertEqual(list(wrapper.to_singlestore_stream(sql, "tsql")), ["SELECT ", "1"])
+        self.assertEqual(list(wrapper.to_singlestore_stream(sql, "tsql")), ["SELECT 1"])
+        post_json.assert_called_once()
+        payload = post_json.call_args[0][1]
+        self.assertTrue(payload["stream"])
+
+        with mock.patch.object(LLMWrapper, "_post_chat", return_value="converted") as post_chat:
+            LLMWrapper(model=BASE_MODEL).to_singlestore(sql, "tsql")
+        self.assertEqual(payload["options"], post_chat.call_args[0][1])
+
+        lines[:] = [b'{"error": "model not found"}']
+        with self.assertRaisesRegex(RuntimeError, "model not found"):
+            list(LLMWrapper(model=BASE_MODEL).to_singlestore_stream(sql, "tsql"))
+
+
+VECTORS = {"a": [1.0, 0.0], "a'": [0.99, 0.1], "b": [0.0, 1.0]}
+
+
+@mock.patch("sqlglot.llm_wrapper.time.monotonic", return_value=0.0)
+class TestResponseCache(unittest.TestCase):
+    def test_ttl(self, monotonic):
+        cache = _ResponseCache(ttl=10)
+        cache.set("s", "a", "x")
+        self.assertEqual(cache.get("s", "a"), ("x", None))
+
+        monotonic.return_value = 10.0
+        self.assertEqual(cache.get("s", "a"), (None, None))
+        self.assertEqual(len(cache._entries), 0)
+
+    def test_lru_eviction(self, monotonic):
+        cache = _ResponseCache(max_entries=2)
+        cache.set("s", "a", "x")
+        cache.set("s", "b", "y")
+        cache.get("s", "a")
+        cache.set("s", "c", "z")
+
+        self.assertEqual(cache.get("s", "a")[0], "x")
+        self.assertIsNone(cache.get("s", "b")[0])
+        self.assertEqual(cache.get("s", "c")[0], "z")
+
+    def test_scopes(self, monotonic):
+        cache = _ResponseCache()
+        cache.set("s", "a", "x")
+        self.assertIsNone(cache.get("t", "a")[0])
+
+    def test_embedding_fallback(self, monotonic):
+        embed = mock.Mock(side_effect=VECTORS.__getitem__)
+        cache = _ResponseCache(ttl=10, embed=embed)
+
+        self.assertEqual(cache.get_or_call("s", "a", lambda: "x"), "x")
+        self.assertEqual(cache.get_or_call("s", "a'", lambda: "y"), "x")
+        self.assertEqual(cache.get_or_call("s", "b", lambda: "y"), "y")
+        self.assertEqual(cache.get_or_call("t", "a'", lambda: "z"), "z")
+
+        embed.reset_mock()
+        response, vector = cache.get("s", "a")
+        self.assertEqual(response, "x")
+        self.assertEqual(vector, [1.0, 0.0])
+        embed.assert_not_called()
+
+        cache.embed = lambda text: self.assertFalse(cache._lock.locked()) or VECTORS[text]
+        self.assertEqual(cache.get("s", "a'")[0], "x")
+
+        cache.set("u", "a", "w", [1.0, 0.0])
+        monotonic.return_value = 10.0
+        self.assertEqual(cache.get("u", "a'"), (None, cache._unit(VECTORS["a'"])))
+
+    def test_lock(self, monotonic):
+        cache = _ResponseCache(embed=VECTORS.__getitem__)
+        threads = []
+
+        class Racy(float):
+            def __rmul__(self, other):
+                # Store another entry while the cache is being scanned
+                if not threads:
+                    threads.append(threading.Thread(target=cache.set, args=("s", "b", "y")))
+                    threads[0].start()
+                    threads[0].join(0.1)
+                return other * float(self)
+
+        cache.set("s", "a", "x", [Racy(1.0), Racy(0.0)])
+        cache.set("s", "c", "z", [0.0, 1.0])
+        self.assertEqual(cache.get("s", "a'")[0], "x")
+
+        threads[0].join()
+        self.assertEqual(cache.get("s", "b")[0], "y")
@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from sqlglot import procedure, transpile_procedure, transpile_procedures_async
+
+
+class TestProcedure(unittest.TestCase):
+    @mock.patch("sqlglot.procedure._call_llm")
+    def test_transpile_procedure(self, call_llm):
+        call_llm.return_value = "SELECT TOP 1 a FROM t; UPDATE t SET a = ISNULL(b, 0);"
+
+        self.assertEqual(
+            transpile_procedure("CREATE PROCEDURE p AS ..."),
+            "DELIMITER //\nSELECT a FROM t LIMIT 1;\nUPDATE t SET a = COALESCE(b, 0);\n//\nDELIMITER ;",
+        )
+
+    @mock.patch("sqlglot.procedure._parallel_map", wraps=procedure._parallel_map)
+    @mock.patch("sqlglot.procedure._call_llm")
+    def test_transpile_procedure_duplicates(self, call_llm, parallel_map):
+        call_llm.return_value = "SELECT TOP 1 a FROM t; SELECT  TOP 1 a\nFROM t; SELECT b FROM u"
+
+        self.assertEqual(
+            transpile_procedure("CREATE PROCEDURE p AS ..."),
+            "DELIMITER //\nSELECT a FROM t LIMIT 1;\nSELECT a FROM t LIMIT 1;\nSELECT b FROM u;\n//\nDELIMITER ;",
+        )
+        self.assertEqual(
+            parallel_map.call_args[0][1],
+            [
+                ("SELECT TOP 1 a FROM t", "tsql", "singlestore"),
+                ("SELECT b FROM u", "tsql", "singlestore"),
+            ],
+        )
+
+    def test_transpile_procedures_async(self):
+        import httpx
+
+        def handler(request):
+            prompt = procedure._loads(request.content)["prompt"]
+            table = "t" if "PROCEDURE p" in prompt else "u"
+            return httpx.Response(200, json={"response": f"SELECT TOP 1 a FROM {table}"})
+
+        self.assertEqual(
+            asyncio.run(
+                transpile_procedures_async(
+                    ["CREATE PROCEDURE p AS ...", "CREATE PROCEDURE q AS ..."],
+                    transport=httpx.MockTransport(handler),
+                )
+            ),
+            [
+                "DELIMITER //\nSELECT a FROM t LIMIT 1;\n//\nDELIMITER ;",
+                "DELIMITER //\nSELECT a FROM u LIMIT 1;\n//\nDELIMITER ;",
+            ],
+        )
+
+    def test_broken_pool(self):
+        pool = mock.Mock()
+        pool.map.side_effect = procedure.BrokenProcessPool
+
+        with mock.patch("sqlglot.procedure._POOL", pool):
+            self.assertEqual(
+                procedure._parallel_map(
+                    procedure._safe_transpile,
+                    [
+                        ("SELECT TOP 1 a FROM t", "tsql", "singlestore"),
+                        ("SELECT 1", "tsql", "singlestore"),
+                    ],
+                ),
+                ["SELECT a FROM t LIMIT 1", "SELECT 1"],
+            )
+            self.assertIsNone(procedure._POOL)
+
+        pool.shutdown.assert_called_once_with(wait=False)
+
+    def test_transpile_unique_literals(self):
+        self.assertEqual(
+            procedure._transpile_unique(
+                procedure._safe_transpile,
+                [
+                    "SELECT * FROM t WHERE n = 'a  b'",
+                    "SELECT *  FROM t\nWHERE n = 'a b'",
+                    "SELECT * FROM t WHERE n = 'a  b'",
+                ],
+                "tsql",
+                "singlestore",
+            ),
+            [
+                "SELECT * FROM t WHERE n = 'a  b'",
+                "SELECT * FROM t WHERE n = 'a b'",
+                "SELECT * FROM t WHERE n = 'a  b'",
+            ],
+        )